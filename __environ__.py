@@ -5,13 +5,19 @@ from pathlib import Path
 
 BASE_DIR = Path(__file__).parent
 
-if not (TOKEN := os.environ.get('TELEGRAM_BOT_TOKEN')):
+# Several tokens (comma separated in env, one per line in file) host several bots in one process
+if not (TOKENS := os.environ.get('TELEGRAM_BOT_TOKEN')):
     with open(BASE_DIR / 'TOKEN') as f:
-        TOKEN = f.read().strip()
+        TOKENS = f.read()
 
-if not TOKEN:
+TOKENS = [token.strip() for token in TOKENS.replace(',', '\n').splitlines() if token.strip()]
+
+if not TOKENS:
     raise KeyError('No TOKEN found!')
 
+# Users or chats allowed to use admin commands, comma separated ids
+ADMIN_IDS = {int(admin_id) for admin_id in os.environ.get('ADMIN_IDS', '').split(',') if admin_id.strip()}
+
 
 # Change the name of environment variable to be read here
 DEPLOY_ENV_VAR_NAME = 'DEPLOY_ENV'
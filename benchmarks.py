@@ -0,0 +1,320 @@
+"""
+Benchmark harnesses driving updates through a real Dispatcher against a fake Telegram API
+
+Run with ``python benchmarks.py [name ...]``, all benchmarks are run if no name is given.
+"""
+import gc
+import importlib.util
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from queue import Queue
+from threading import Event, Lock, Thread
+
+from telegram import Chat, Message, MessageEntity, ParseMode, Update, User
+from telegram.ext import CommandHandler, Defaults, Dispatcher, ExtBot, JobQueue
+
+BOT_ID = 100000
+BOT_TOKEN = f'{BOT_ID}:{"A" * 35}'
+
+class FakeRequest:
+    """Stands in for ``telegram.utils.request.Request``, counting API calls and simulating network latency."""
+    con_pool_size = 100
+
+    def __init__(self, latency: float=0) -> None:
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._lock = Lock()
+
+    def post(self, url: str, data: dict, timeout: float=None):
+        endpoint = url.rsplit('/', 1)[1]
+        with self._lock:
+            self.calls[endpoint] += 1
+            message_id = next(self._message_ids)
+        if self.latency:
+            time.sleep(self.latency)
+        if endpoint == 'getUpdates':
+            # Long polling that never receives anything
+            time.sleep(0.2)
+            return []
+        if endpoint == 'getMe':
+            return {'id': int(url.rsplit('/', 2)[1][3:].split(':')[0]), 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if endpoint in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': data.get('message_id', message_id),
+                'date': int(time.time()),
+                'chat': {'id': int(data['chat_id']), 'type': Chat.PRIVATE},
+                'text': data['text'],
+            }
+        return True
+
+    def stop(self) -> None:
+        pass
+
+def make_bot(request: FakeRequest, token: str=BOT_TOKEN) -> ExtBot:
+    return ExtBot(token, request=request, defaults=Defaults(parse_mode=ParseMode.HTML))
+
+def make_dispatcher(bot: ExtBot, workers: int=4, job_queue: bool=False) -> Dispatcher:
+    dispatcher = Dispatcher(bot, Queue(), workers=workers, job_queue=JobQueue() if job_queue else None, use_context=True)
+    if job_queue:
+        dispatcher.job_queue.set_dispatcher(dispatcher)
+        dispatcher.job_queue.start()
+    # Starting the dispatcher thread starts its run_async worker pool, updates are still fed with process_update
+    ready = Event()
+    Thread(target=dispatcher.start, kwargs={'ready': ready}, daemon=True).start()
+    ready.wait()
+    return dispatcher
+
+def stop_dispatcher(dispatcher: Dispatcher) -> None:
+    if dispatcher.job_queue:
+        dispatcher.job_queue.stop()
+    dispatcher.stop()
+
+def outgoing_calls(request: FakeRequest) -> int:
+    return sum(count for endpoint, count in request.calls.items() if endpoint != 'getMe')
+
+def load_module_at(rev: str, path: str, name: str):
+    """Import a module as it was at a git revision, to compare against the working tree."""
+    source = subprocess.run(['git', 'show', f'{rev}:{path}'], capture_output=True, text=True, check=True).stdout
+    spec = importlib.util.spec_from_loader(name, loader=None)
+    module = importlib.util.module_from_spec(spec)
+    # Registered first, as dataclass helpers look their module up
+    sys.modules[name] = module
+    exec(source, module.__dict__)
+    return module
+
+def commit_before(request_id: str) -> str:
+    commit = subprocess.run(['git', 'log', '--format=%H', f'--grep=^\\[{request_id}\\] ', '--reverse'], capture_output=True, text=True, check=True).stdout.split()[0]
+    return f'{commit}^'
+
+_update_ids = itertools.count(1)
+
+def make_update(bot: ExtBot, text: str, user_id: int, chat_id: int=None) -> Update:
+    update_id = next(_update_ids)
+    entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))] if text.startswith('/') else []
+    user = User(user_id, f'user{user_id}', False, username=f'user{user_id}', bot=bot)
+    chat = Chat(chat_id or user_id, Chat.PRIVATE, username=f'user{user_id}', bot=bot)
+    message = Message(update_id, datetime.now(), chat, from_user=user, text=text, entities=entities, bot=bot)
+    return Update(update_id, message=message)
+
+def bench_flood() -> None:
+    """user-026: throughput for legitimate users while one user floods the dispatcher."""
+    from utils.rate_limit_util import FloodGuard
+
+    FLOOD_SIZE, LEGIT_USERS, LEGIT_MESSAGES = 10000, 100, 5
+    FLOODER = 1
+
+    for guarded in (False, True):
+        request = FakeRequest()
+        bot = make_bot(request)
+        dispatcher = make_dispatcher(bot)
+        handled = Counter()
+        dispatcher.add_handler(CommandHandler('ping', lambda update, context: handled.update([update.effective_user.id == FLOODER])))
+        if guarded:
+            dispatcher.add_handler(FloodGuard().get_handler(), group=-1)
+
+        legit = [make_update(bot, '/ping', user_id) for user_id in range(2, LEGIT_USERS + 2) for _ in range(LEGIT_MESSAGES)]
+        flood = [make_update(bot, '/ping', FLOODER) for _ in range(FLOOD_SIZE)]
+        # Spread legitimate updates evenly over the flood
+        step = len(flood) // len(legit)
+        updates = []
+        for i, update in enumerate(flood):
+            updates.append(update)
+            if i % step == 0 and i // step < len(legit):
+                updates.append(legit[i // step])
+
+        start = time.perf_counter()
+        for update in updates:
+            dispatcher.process_update(update)
+        elapsed = time.perf_counter() - start
+
+        print(f"[flood] guard={'on ' if guarded else 'off'} {len(updates)} updates in {elapsed:.3f}s ({len(updates) / elapsed:,.0f} updates/s), "
+              f"legit handled {handled[False]}/{len(legit)}, flood handled {handled[True]}/{FLOOD_SIZE}, "
+              f"outgoing calls {sum(request.calls.values())}")
+        stop_dispatcher(dispatcher)
+
+def bench_registration() -> None:
+    """user-027: outgoing API calls of one registration, before and after the live draft message."""
+    import medication
+
+    USER = 42
+    GAP_SECS = 0.5
+    SCRIPT = ['/register', 'Bench樣', '/add 藥A 1錠', '/add 藥B 2錠', '/add 藥C 1包', '/del 2', '/add 藥D 1錠', '/end']
+
+    before = load_module_at(commit_before('user-027'), 'medication.py', 'medication_before')
+    results = {}
+    for label, conversation in (('before', before.REGISTER_CONVERSATION), ('after', medication.get_register_conversation())):
+        request = FakeRequest()
+        bot = make_bot(request)
+        dispatcher = make_dispatcher(bot, job_queue=True)
+        dispatcher.add_handler(conversation)
+        for text in SCRIPT:
+            dispatcher.process_update(make_update(bot, text, USER))
+            time.sleep(GAP_SECS)
+        stop_dispatcher(dispatcher)
+        results[label] = outgoing_calls(request)
+        print(f"[registration] {label:<6} {results[label]} outgoing calls {dict(request.calls)}")
+    print(f"[registration] calls cut by {results['before'] / results['after']:.1f}x")
+
+def bench_deletion() -> None:
+    """user-028: 1000 bad commands must not starve other handlers while their usage messages await deletion."""
+    from utils.command_util import Command, Parameter, command_usage
+    from utils.deletion_util import get_deletion_scheduler
+
+    BAD_COMMANDS, USER = 1000, 42
+    # The baseline slept 10s per usage message, shortened here so its run finishes
+    SLEEPING_DELAY = 0.05
+
+    before = load_module_at(commit_before('user-028'), 'utils/command_util.py', 'command_util_before')
+    for label in ('sleeping threads', 'scheduler'):
+        request = FakeRequest()
+        bot = make_bot(request)
+        dispatcher = make_dispatcher(bot, job_queue=True)
+        if label == 'scheduler':
+            get_deletion_scheduler(bot).attach(dispatcher)
+            bad = Command('bad', lambda *args: None, 'bad', [Parameter('number', int, 'number')])
+            dispatcher.add_handler(CommandHandler('bad', bad.get_handler()))
+        else:
+            def bad_usage(update: Update, context) -> None:
+                message = command_usage('bad', [], 'bad', update.effective_message)
+                context.dispatcher.run_async(before._delete_after, SLEEPING_DELAY, message)
+            dispatcher.add_handler(CommandHandler('bad', bad_usage))
+        pinged = Event()
+        dispatcher.add_handler(CommandHandler('ping', lambda update, context: pinged.set(), run_async=True))
+
+        start = time.perf_counter()
+        for _ in range(BAD_COMMANDS):
+            dispatcher.process_update(make_update(bot, '/bad not-a-number', USER))
+        flooded = time.perf_counter()
+        dispatcher.process_update(make_update(bot, '/ping', USER))
+        pinged.wait()
+        latency = time.perf_counter() - flooded
+
+        pending = len(get_deletion_scheduler(bot)) if label == 'scheduler' else 0
+        print(f"[deletion] {label:<16} {BAD_COMMANDS} bad commands in {flooded - start:.3f}s, "
+              f"other handler ran after {latency * 1000:.1f}ms, pending deletions {pending}, deleted {request.calls['deleteMessage']}")
+        if label == 'scheduler':
+            # Make every deletion due and let the sweep job drain them in batches
+            scheduler = get_deletion_scheduler(bot)
+            with scheduler._lock:
+                scheduler.heap[:] = [(0, chat_id, message_id) for _, chat_id, message_id in scheduler.heap]
+                scheduler._arm()
+            time.sleep(3.5)
+            print(f"[deletion] {label:<16} 3.5s after all became due: deleted {request.calls['deleteMessage']}, pending {len(scheduler)}, "
+                  f"sweep jobs queued {len(dispatcher.job_queue.jobs())}")
+        stop_dispatcher(dispatcher)
+
+def bench_reminders() -> None:
+    """user-029: plan build time and dispatcher CPU at 100k remindees, with and without the plan."""
+    import random
+    import types
+    import reminder
+    from reminder import Medication, Remindee, ReminderPlan, dispatch_plans, get_plan
+    from utils.rate_limit_util import RateLimit, TokenBucketTable
+
+    REMINDEE_COUNT = 100_000
+    remindees = {
+        user_id: Remindee(
+            f'user{user_id}',
+            [Medication(f'med{random.randrange(100)}', f'{random.randrange(1, 4)}錠') for _ in range(random.randrange(1, 4))],
+            user_id, f'user{user_id}'
+        ).to_dict()
+        for user_id in range(1, REMINDEE_COUNT + 1)
+    }
+
+    start = time.perf_counter()
+    ReminderPlan().build(remindees)
+    print(f"[reminders] plan build: {REMINDEE_COUNT} remindees in {time.perf_counter() - start:.3f}s")
+
+    # Throttling is lifted so only the CPU spent by the dispatcher is measured
+    reminder.DELIVERY_BUCKETS = TokenBucketTable(RateLimit(1e9, 1e9))
+    reminder.CHAT_DELIVERY_BUCKETS = TokenBucketTable(RateLimit(1e9, 1e9), max_keys=REMINDEE_COUNT)
+
+    # Before: one job per remindee, formatting its message at fire time
+    before = load_module_at(commit_before('user-029'), 'reminder.py', 'reminder_before')
+    request = FakeRequest()
+    context = types.SimpleNamespace(bot=make_bot(request))
+    reminds = [before.generate_remind(before.Remindee.from_dict(remindee)) for remindee in remindees.values()]
+    start = time.process_time()
+    for remind in reminds:
+        remind(context)
+    print(f"[reminders] dispatch CPU without plan: {time.process_time() - start:.3f}s for {request.calls['sendMessage']} reminders")
+    del reminds
+    gc.collect()
+
+    # After: the real dispatch_plans streaming through the plan
+    request = FakeRequest()
+    bot = make_bot(request)
+    dispatcher = types.SimpleNamespace(bot=bot, bot_data={'remindees': remindees}, update_persistence=lambda: None)
+    get_plan(bot).build(remindees)
+    start = time.process_time()
+    dispatch_plans(types.SimpleNamespace(job=types.SimpleNamespace(context=[dispatcher])))
+    print(f"[reminders] dispatch CPU with plan:    {time.process_time() - start:.3f}s for {request.calls['sendMessage']} reminders")
+
+def rss_kib() -> int:
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+
+def run_tenants_child(count: int) -> None:
+    """Start ``count`` fully set up, polling bots in this process and report its memory."""
+    tokens = [f'{BOT_ID + i}:{"A" * 35}' for i in range(count)]
+    os.environ['TELEGRAM_BOT_TOKEN'] = ','.join(tokens)
+    os.environ['DEPLOY_ENV'] = 'prod'
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot.py logs to bot.log in the working directory
+        os.chdir(tmp)
+        import bot
+        import reminder
+        import tenants
+
+        updaters = tenants.create_updaters(tokens, request=FakeRequest(), base_dir=Path(tmp))
+        job_queue = updaters[0].job_queue
+        for updater in updaters:
+            bot.setup_dispatcher(updater.dispatcher, job_queue)
+        reminder.schedule_reminders(job_queue, [updater.dispatcher for updater in updaters])
+        for updater in updaters:
+            updater.start_polling()
+        time.sleep(2)
+        print(f'RESULT {rss_kib()} {threading.active_count()}', flush=True)
+        for updater in updaters:
+            updater.stop()
+
+def bench_tenants() -> None:
+    """user-031: memory of each added bot in a shared process, against running it as a separate process."""
+    ADDED = 10
+
+    def measure(count: int):
+        output = subprocess.run([sys.executable, __file__, '--tenants-child', str(count)], capture_output=True, text=True, check=True).stdout
+        rss, threads = next(line for line in output.splitlines() if line.startswith('RESULT')).split()[1:]
+        return int(rss), int(threads)
+
+    single_rss, single_threads = measure(1)
+    multi_rss, multi_threads = measure(1 + ADDED)
+    per_tenant = (multi_rss - single_rss) / ADDED
+    print(f"[tenants] 1 bot: {single_rss / 1024:.1f} MiB, {single_threads} threads; "
+          f"{1 + ADDED} bots: {multi_rss / 1024:.1f} MiB, {multi_threads} threads")
+    print(f"[tenants] per added bot: {per_tenant / 1024:.2f} MiB in process vs {single_rss / 1024:.1f} MiB as a separate process, "
+          f"saving {(single_rss - per_tenant) / 1024:.1f} MiB per bot")
+
+BENCHMARKS = {
+    'flood': bench_flood,
+    'registration': bench_registration,
+    'deletion': bench_deletion,
+    'reminders': bench_reminders,
+    'tenants': bench_tenants,
+}
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--tenants-child']:
+        run_tenants_child(int(sys.argv[2]))
+    else:
+        for name in sys.argv[1:] or BENCHMARKS:
+            BENCHMARKS[name]()
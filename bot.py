@@ -1,17 +1,20 @@
 # Metadata
-from __environ__ import TOKEN, DEVELOPMENT_MODE
+from __environ__ import ADMIN_IDS, TOKENS, DEVELOPMENT_MODE
 from __version__ import __version__
 __botname__ = 'Medication Reminder'
 
 # Imports
-from pathlib import Path
-from telegram import ParseMode
-from telegram.ext import CommandHandler, Defaults, Updater, PicklePersistence
+from telegram.ext import CommandHandler, Dispatcher, JobQueue
 from utils.command_util import Command, Parameter, dumpall
+from utils.deletion_util import get_deletion_scheduler
+from utils.rate_limit_util import FloodGuard, RateLimit
 
+from calc_date import check_equation
 from commands import calc_time, generate_version, say, getcontext
-from reminder import Remindee, generate_remind
-from medication import REGISTER_CONVERSATION, list_all
+from reminder import schedule_reminders
+from medication import get_register_conversation, list_all
+from tenants import create_updaters
+from stats import show_stats, show_top_medications
 
 # Logging
 import sys
@@ -28,52 +31,55 @@ root_logger.addHandler(fileHandler)
 root_logger.addHandler(streamHandler)
 logger = logging.getLogger(__name__) 
 
-def main():
-    logger.info(f"Running {__botname__} BOT version {__version__}...")
-    updater = Updater(
-        defaults = Defaults(
-            parse_mode = ParseMode.HTML,
-            disable_notification=True,
-            disable_web_page_preview=False
-        ),
-        token = TOKEN,
-        use_context = True,
-        persistence=PicklePersistence(Path(__file__).parent / "bot.db"),
-    )
-    dispatcher = updater.dispatcher
-
+def setup_dispatcher(dispatcher: Dispatcher, job_queue: JobQueue):
     # Register commands
     COMMANDS = [
         Command('version', generate_version(__version__), 'バージョン表示', []),
-        Command('calc', calc_time, '時間計算', [Parameter('equation', str, '公式')], last_ignore_space=True),
+        Command('calc', calc_time, '時間計算', [Parameter('equation', str, '公式', check_equation)], last_ignore_space=True, rate_limit=RateLimit.per_minute(10)),
         Command('say', say, '說話', [
             Parameter('chat_id', str, '聊天ID'),
             Parameter('content', str, '聊天內容')
-        ], last_ignore_space=True),
+        ], last_ignore_space=True, rate_limit=RateLimit.per_minute(5)),
         Command('getcontext', getcontext, '現實當前聊天詳情', []),
         Command('list', list_all, '列出已登記藥物', []),
-        Command('dumpall', dumpall, '打印所有 BOT 數據', [])
+        Command('dumpall', dumpall, '打印所有 BOT 數據', [], rate_limit=RateLimit.per_minute(1, burst=2)),
+        Command('stats', show_stats, '統計數據', [Parameter('check', bool, '是否與全量統計對比', optional=True)], allowed_ids=ADMIN_IDS),
+        Command('topmeds', show_top_medications, '最常見的藥物', [Parameter('count', int, '顯示數量', lambda x: 0 < x <= 50, optional=True)], allowed_ids=ADMIN_IDS)
     ]
 
+    # Drop updates from flooding users / chats before any other handler runs
+    dispatcher.add_handler(FloodGuard().get_handler(), group=-1)
+
     logger.debug('Registering Commands...')
     for command in COMMANDS:
         logger.debug(f'  { command.name } - { command.description }')
         dispatcher.add_handler(CommandHandler(command.name, command.get_handler()))
 
-    dispatcher.add_handler(REGISTER_CONVERSATION)
+    dispatcher.add_handler(get_register_conversation())
+
+    get_deletion_scheduler(dispatcher.bot).attach(dispatcher, job_queue)
+
+def main():
+    logger.info(f"Running {__botname__} BOT version {__version__} with {len(TOKENS)} bot(s)...")
+    updaters = create_updaters(TOKENS)
+    # Reminders and deletions of all bots are scheduled on the first bot's job queue
+    job_queue = updaters[0].job_queue
 
-    jobqueue = updater.job_queue
+    for updater in updaters:
+        setup_dispatcher(updater.dispatcher, job_queue)
 
-    if (remindees := dispatcher.bot_data.get('remindees')):
-        for remindee in map(Remindee.from_dict, remindees.values()):
-            from datetime import datetime
-            from pytz import timezone
-            jobqueue.run_daily(generate_remind(remindee), time=timezone('Asia/Tokyo').localize(datetime(1970, 1, 1, 0, 0)))
+    schedule_reminders(job_queue, [updater.dispatcher for updater in updaters])
 
     logger.info("Starting Polling...")
-    updater.start_polling()
+    for updater in updaters:
+        updater.start_polling()
 
-    updater.idle()
+    updaters[0].idle()
+    for updater in updaters:
+        # Only the first updater persists on its own when signalled, save every bot once all have stopped
+        updater.stop()
+        updater.dispatcher.update_persistence()
+        updater.persistence.flush()
 
 if __name__ == '__main__':
     main()
@@ -128,6 +128,23 @@ def evaluate_stack(s):
         # except ValueError:
         #     return float(op)
 
+MAX_EQUATION_LENGTH = 256
+MAX_PARENTHESES_DEPTH = 16
+
+def check_equation(equation: str) -> bool:
+    """Reject equations too long or too deeply nested to be parsed safely."""
+    if len(equation) > MAX_EQUATION_LENGTH:
+        return False
+    depth = 0
+    for char in equation:
+        if char == '(':
+            depth += 1
+            if depth > MAX_PARENTHESES_DEPTH:
+                return False
+        elif char == ')':
+            depth -= 1
+    return True
+
 def evaluate(equation: str) -> Union[datetime, timedelta]:    
     BNF().parseString(equation, parseAll=True)
     val = evaluate_stack(expr_stack[:])
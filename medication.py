@@ -1,7 +1,14 @@
+import logging
+logger = logging.getLogger(__name__)
+
 from enum import IntEnum, auto
+from html import escape
+from threading import Lock
+from typing import Dict, Tuple
 from reminder import Medication, Remindee, append_remindee, get_remindee, update_medications
 
-from telegram import Update, user
+from telegram import Bot, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     CallbackContext,
     CommandHandler,
@@ -17,6 +24,71 @@ class States(IntEnum):
     NEW_USER = auto()
     MEDICATION = auto()
 
+DRAFT_DEBOUNCE_SECS = 1.5
+
+def render_draft(user_data: dict, header: str) -> str:
+    medications = list(map(Medication.from_dict, user_data.get('new_medications', [])))
+    return (
+        f'{header}{NEWLINE}{NEWLINE}'
+        f'{render_medication_list(medications)}{NEWLINE}{NEWLINE}'
+        f'請使用 /add 來登記新的藥物，/del 來刪除既有的藥物，/end 結束輸入，/cancel 取消操作，格式如下：{NEWLINE}{NEWLINE}'
+        f'{ADD_COMMAND.render_usage()}{NEWLINE}{NEWLINE}'
+        f'{DEL_COMMAND.render_usage()}'
+    )
+
+def send_draft(update: Update, context: CallbackContext, header: str) -> None:
+    """Send the live draft message of this registration, which is edited in place afterwards."""
+    context.user_data['draft_header'] = header
+    message = update.effective_message.reply_text(text=render_draft(context.user_data, header))
+    context.user_data['draft_message'] = (message.chat_id, message.message_id)
+
+# Serialises the debounced flush and the final edit of a draft, per bot and user
+_draft_locks: Dict[str, Lock] = {}
+
+def _draft_key(bot: Bot, user_id: int) -> str:
+    return f"draft-{bot.token.split(':')[0]}-{user_id}"
+
+def _edit_draft(bot: Bot, draft_message: Tuple[int, int], text: str) -> None:
+    chat_id, message_id = draft_message
+    try:
+        bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+    except BadRequest as e:
+        # A debounced flush may render exactly what is already shown
+        if 'message is not modified' in e.message.lower():
+            return
+        logger.warning(f'Failed to edit draft message {message_id} in chat {chat_id}: {e}')
+
+def _flush_draft(context: CallbackContext) -> None:
+    # The job queue may be shared between bots, so the job carries the dispatcher of its draft
+    dispatcher, user_id = context.job.context
+    user_data = dispatcher.user_data[user_id]
+    with _draft_locks.setdefault(_draft_key(dispatcher.bot, user_id), Lock()):
+        # The draft may have been closed while this flush was waiting
+        if (draft_message := user_data.get('draft_message')):
+            _edit_draft(dispatcher.bot, draft_message, render_draft(user_data, user_data.get('draft_header', '')))
+
+def update_draft(update: Update, context: CallbackContext, header: str) -> None:
+    """Debounce edits of the draft message: bursts of /add and /del are folded into one edit."""
+    context.user_data['draft_header'] = header
+    key = _draft_key(context.bot, update.effective_user.id)
+    if not context.job_queue.get_jobs_by_name(key):
+        context.job_queue.run_once(_flush_draft, DRAFT_DEBOUNCE_SECS, context=(context.dispatcher, update.effective_user.id), name=key)
+
+def close_draft(update: Update, context: CallbackContext, text: str) -> None:
+    """Cancel pending edits and replace the draft message with the final text."""
+    key = _draft_key(context.bot, update.effective_user.id)
+    for job in context.job_queue.get_jobs_by_name(key):
+        job.schedule_removal()
+    with _draft_locks.setdefault(key, Lock()):
+        context.user_data.pop('draft_header', None)
+        draft_message = context.user_data.pop('draft_message', None)
+        if draft_message:
+            _edit_draft(context.bot, draft_message, text)
+        # A flush still waiting holds the lock object itself and finds the draft gone
+        _draft_locks.pop(key, None)
+    if not draft_message:
+        reply(update, context, text)
+
 def register(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
     
@@ -27,14 +99,8 @@ def register(update: Update, context: CallbackContext) -> int:
         )
 
     if (remindee := get_remindee(user_id, context)):
-        reply(
-            update, context,
-            f'{remindee.nickname}，歡迎回來！{render_medication_list(remindee.medications)}{NEWLINE}'
-            f'請使用 /add 來登記新的藥物，/del 來刪除既有的藥物，格式如下：（若想取消操作請使用 /cancel）'
-        )
         context.user_data['new_medications'] = remindee.to_dict()['medications']
-        ADD_COMMAND.print_usage(update)
-        DEL_COMMAND.print_usage(update)
+        send_draft(update, context, f'{escape(remindee.nickname)}，歡迎回來！')
         return States.MEDICATION
     else:
         reply(
@@ -48,11 +114,7 @@ def new_user(update: Update, context: CallbackContext) -> int:
     remindee = Remindee(nickname, [], update.effective_chat.id, update.effective_user.username)
     append_remindee(update.effective_user.id, remindee, context)
     context.user_data['new_medications'] = []
-    reply(
-        update, context,
-        f'{nickname}，歡迎使用我！請在下面使用 /add 來登記藥物，格式如下：'
-    )
-    ADD_COMMAND.print_usage(update)
+    send_draft(update, context, f'{escape(nickname)}，歡迎使用我！')
     return States.MEDICATION
 
 def add_medication(update: Update, context: CallbackContext, command: Command, args: list) -> int:
@@ -61,10 +123,7 @@ def add_medication(update: Update, context: CallbackContext, command: Command, a
     name = args['name']
     amount = args['amount']
     context.user_data['new_medications'].append(Medication(name, amount).to_dict())        
-    reply(
-        update, context,
-        f"添加 {name} {amount} 成功！使用 /end 指令以結束輸入"
-    )
+    update_draft(update, context, f"添加 {escape(name)} {escape(amount)} 成功！")
     return States.MEDICATION
 
 def del_medication(update: Update, context: CallbackContext, command: Command, args: list) -> int:
@@ -75,38 +134,23 @@ def del_medication(update: Update, context: CallbackContext, command: Command, a
     index: int = args['index']
     try:
         deleted = Medication.from_dict(context.user_data['new_medications'].pop(index - 1))
-    except KeyError:
-        reply(
-            update, context,
-            f'序號不合法！'
-        )
+    except IndexError:
+        update_draft(update, context, f'序號不合法！')
         return States.MEDICATION
 
-    reply(
-        update, context,
-        f"刪除 {deleted} 成功！使用 /end 指令以結束輸入"
-    )
+    update_draft(update, context, f"刪除 {escape(str(deleted))} 成功！")
     return States.MEDICATION
 
 def end_medication(update: Update, context: CallbackContext) -> None:
     if not (new_medications := context.user_data.get('new_medications')):
-        reply(
-            update, context,
-            f'未添加任何新藥物！'
-        )
+        close_draft(update, context, f'未添加任何新藥物！')
         return ConversationHandler.END
     remindee = update_medications(update.effective_user.id, list(map(Medication.from_dict, new_medications)), context)
-    reply(
-        update, context,
-        f'更新成功！{render_medication_list(remindee.medications)}'
-    )
+    close_draft(update, context, f'更新成功！{render_medication_list(remindee.medications)}')
     return ConversationHandler.END
 
 def cancel(update: Update, context: CallbackContext) -> int:
-    reply(
-        update, context,
-        f'操作已取消。'
-    )
+    close_draft(update, context, f'操作已取消。')
     return ConversationHandler.END
 
 ADD_COMMAND = Command('add', add_medication, '添加藥物', [
@@ -114,31 +158,33 @@ ADD_COMMAND = Command('add', add_medication, '添加藥物', [
                 Parameter('amount', str, '藥物的量')    
             ])
 DEL_COMMAND = Command('del', del_medication, '刪除藥物', [
-                Parameter('index', int, '藥物序號')
+                Parameter('index', int, '藥物序號', lambda x: x > 0)
             ])
 
-REGISTER_CONVERSATION = ConversationHandler(
-    entry_points=[
-        CommandHandler('register', register)
-    ],
-    states={
-        States.NEW_USER: [MessageHandler(Filters.regex('[^ @/]+'), new_user)],
-        States.MEDICATION: [
-            CommandHandler('add', ADD_COMMAND.get_handler()),
-            CommandHandler('del', DEL_COMMAND.get_handler()),
-            CommandHandler('end', end_medication)
+def get_register_conversation() -> ConversationHandler:
+    # A ConversationHandler tracks conversation states itself, so every dispatcher needs its own
+    return ConversationHandler(
+        entry_points=[
+            CommandHandler('register', register)
+        ],
+        states={
+            States.NEW_USER: [MessageHandler(Filters.regex('[^ @/]+'), new_user)],
+            States.MEDICATION: [
+                CommandHandler('add', ADD_COMMAND.get_handler()),
+                CommandHandler('del', DEL_COMMAND.get_handler()),
+                CommandHandler('end', end_medication)
+            ]
+        },
+        fallbacks=[
+            CommandHandler('cancel', cancel)
         ]
-    },
-    fallbacks=[
-        CommandHandler('cancel', cancel)
-    ]
-)
+    )
 
 def render_medication_list(medications: list[Medication]) -> str:
     if not medications:
         return '您沒有任何藥物登記在冊，請使用 /register 指令登記！'
     else:
-        medication_list = '\n'.join(f'{i + 1:>3}  <b>{medication.name}</b> {medication.amount}' for i, medication in enumerate(medications))
+        medication_list = '\n'.join(f'{i + 1:>3}  <b>{escape(medication.name)}</b> {escape(medication.amount)}' for i, medication in enumerate(medications))
         return f'您現在擁有以下藥物登記在冊：{NEWLINE}{NEWLINE}{medication_list}'
 
 def list_all(update: Update, context: CallbackContext, command: Command, args: list) -> None:
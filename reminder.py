@@ -1,8 +1,31 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from collections import deque
 from dataclasses import dataclass
-from typing import List
+from datetime import datetime
+from html import escape
+from threading import Lock
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Tuple
 
 from mashumaro import DataClassDictMixin
-from telegram.ext import CallbackContext
+from pytz import timezone
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import CallbackContext, Dispatcher, JobQueue
+
+from stats import count_delivery, count_medications, count_users
+from utils.rate_limit_util import RateLimit, TokenBucketTable
+
+REMIND_TIME = timezone('Asia/Tokyo').localize(datetime(1970, 1, 1, 0, 0)).timetz()
+PLAN_TIME = timezone('Asia/Tokyo').localize(datetime(1970, 1, 1, 23, 50)).timetz()
+
+# Telegram allows about 30 messages per second per bot, and 20 per minute per group
+DELIVERY_LIMIT = RateLimit(25, 25)
+DELIVERY_BUCKETS = TokenBucketTable(DELIVERY_LIMIT)
+CHAT_DELIVERY_LIMIT = RateLimit.per_minute(20)
+CHAT_DELIVERY_BUCKETS = TokenBucketTable(CHAT_DELIVERY_LIMIT, max_keys=1_000_000)
 
 @dataclass(unsafe_hash=True)
 class Medication(DataClassDictMixin):
@@ -21,13 +44,73 @@ class Remindee(DataClassDictMixin):
 
     def format_reminder_message(self):
         at_username = f'@{self.username} ' if self.username else ''
-        return f"{at_username}{self.nickname}，您的 {'、'.join(str(med) for med in self.medications)} 已就位，请及时服用〜"
+        return f"{at_username}{escape(self.nickname)}，您的 {'、'.join(escape(str(med)) for med in self.medications)} 已就位，请及时服用〜"
+
+class ReminderPlan:
+    """Precompiled reminders of the next day, so firing only streams through ready-made messages.
+
+    Entries are ``user_id -> (chat_id, text)``, kept up to date incrementally on every
+    medication edit and rebuilt from scratch nightly.
+    """
+    def __init__(self) -> None:
+        self.entries: Dict[int, Tuple[int, str]] = {}
+        # Changes made while a build is running, replayed onto the new entries before the swap
+        self._changes: Optional[Dict[int, Optional[Tuple[int, str]]]] = None
+        self._lock = Lock()
+
+    def build(self, remindees: dict) -> None:
+        with self._lock:
+            self._changes = {}
+        entries = {}
+        # Copied first, as handler threads keep adding and deleting remindees
+        for user_id, remindee in list(remindees.items()):
+            remindee = Remindee.from_dict(remindee)
+            if remindee.medications:
+                entries[user_id] = (remindee.chat_id, remindee.format_reminder_message())
+        with self._lock:
+            for user_id, entry in self._changes.items():
+                if entry:
+                    entries[user_id] = entry
+                else:
+                    entries.pop(user_id, None)
+            self.entries, self._changes = entries, None
+        logger.debug(f'Reminder plan built with {len(entries)} entries')
+
+    def _set(self, user_id: int, entry: Optional[Tuple[int, str]]) -> None:
+        with self._lock:
+            if entry:
+                self.entries[user_id] = entry
+            else:
+                self.entries.pop(user_id, None)
+            if self._changes is not None:
+                self._changes[user_id] = entry
+
+    def update(self, user_id: int, remindee: Remindee) -> None:
+        self._set(user_id, (remindee.chat_id, remindee.format_reminder_message()) if remindee.medications else None)
+
+    def remove(self, user_id: int) -> None:
+        self._set(user_id, None)
+
+    def snapshot(self) -> List[Tuple[int, str]]:
+        with self._lock:
+            return list(self.entries.values())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+REMINDER_PLANS: Dict[str, ReminderPlan] = {}
+
+def get_plan(bot: Bot) -> ReminderPlan:
+    return REMINDER_PLANS.setdefault(bot.token, ReminderPlan())
 
 def append_remindee(user_id: int, remindee: Remindee, context: CallbackContext):
     if not context.bot_data.get('remindees'):
         context.bot_data['remindees'] = {}
     if remindee.username not in context.bot_data['remindees'].keys():
+        count_users(context.bot_data, 1)
+        count_medications(context.bot_data, (med.name for med in remindee.medications), 1)
         context.bot_data['remindees'][user_id] = remindee.to_dict()
+        get_plan(context.bot).update(user_id, remindee)
 
 def get_remindee(user_id: str, context: CallbackContext) -> Remindee:
     if not context.bot_data.get('remindees'):
@@ -38,22 +121,83 @@ def get_remindee(user_id: str, context: CallbackContext) -> Remindee:
 
 def delete_remindee(user_id: int, context: CallbackContext) -> Remindee:
     if (remindee := get_remindee(user_id, context)):
+        count_users(context.bot_data, -1)
+        count_medications(context.bot_data, (med.name for med in remindee.medications), -1)
         del context.bot_data['remindees'][user_id]
+        get_plan(context.bot).remove(user_id)
     return remindee
 
 def update_medications(user_id: int, medications: list[Medication], context: CallbackContext) -> Remindee:
     if not (remindee := get_remindee(user_id, context)):
         return None
     
+    count_medications(context.bot_data, (med.name for med in remindee.medications), -1)
+    count_medications(context.bot_data, (med.name for med in medications), 1)
     remindee.medications = medications
     context.bot_data['remindees'][user_id] = remindee.to_dict()
+    get_plan(context.bot).update(user_id, remindee)
     return remindee
 
 # TODO: update_nickname
-def generate_remind(remindee: Remindee):
-    def remind(context: CallbackContext) -> None:
-        context.bot.send_message(
-            chat_id=remindee.chat_id,
-            text=remindee.format_reminder_message()
-        )
-    return remind
+def build_plans(context: CallbackContext) -> None:
+    for dispatcher in context.job.context:
+        get_plan(dispatcher.bot).build(dispatcher.bot_data.get('remindees', {}))
+
+def dispatch_plans(context: CallbackContext) -> None:
+    """Send the planned reminders of every bot.
+
+    Bots are interleaved so each one is held only by its own rate limit and flood waits, and
+    reminders to a chat over its own limit are put back at the end of their bot's queue rather
+    than holding it up.
+    """
+    pending = [(dispatcher, deque(get_plan(dispatcher.bot).snapshot())) for dispatcher in context.job.context]
+    resume_at: Dict[str, float] = {}
+    delivered = {dispatcher.bot.token: 0 for dispatcher, _ in pending}
+    def flush_deliveries(dispatcher: Dispatcher) -> None:
+        # Counted in bulk, reading the clock once per batch rather than once per reminder
+        if count := delivered[dispatcher.bot.token]:
+            count_delivery(dispatcher.bot_data, count)
+            delivered[dispatcher.bot.token] = 0
+    while pending:
+        progressed = False
+        for dispatcher, entries in list(pending):
+            token = dispatcher.bot.token
+            if not entries:
+                pending.remove((dispatcher, entries))
+                flush_deliveries(dispatcher)
+                # The job queue only persists the dispatcher it is bound to
+                dispatcher.update_persistence()
+                continue
+            if resume_at.get(token, 0) > monotonic():
+                continue
+            chat_id, text = entries[0]
+            if not DELIVERY_BUCKETS.consume(token):
+                continue
+            if not CHAT_DELIVERY_BUCKETS.consume((token, chat_id)):
+                DELIVERY_BUCKETS.refund(token)
+                entries.rotate(-1)
+                continue
+            progressed = True
+            try:
+                dispatcher.bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                # Flood wait: pause only this bot and retry the same reminder instead of losing it
+                logger.warning(f'Flood wait of {e.retry_after}s reminding chat {chat_id}')
+                resume_at[token] = monotonic() + e.retry_after
+                continue
+            except TelegramError as e:
+                logger.warning(f'Failed to remind chat {chat_id}: {e}')
+            else:
+                delivered[token] += 1
+            entries.popleft()
+        if not progressed:
+            for dispatcher, _ in pending:
+                flush_deliveries(dispatcher)
+            sleep(1 / DELIVERY_LIMIT.rate)
+
+def schedule_reminders(job_queue: JobQueue, dispatchers: List[Dispatcher]) -> None:
+    """Schedule reminders of all bots on one shared job queue."""
+    for dispatcher in dispatchers:
+        get_plan(dispatcher.bot).build(dispatcher.bot_data.get('remindees', {}))
+    job_queue.run_daily(build_plans, time=PLAN_TIME, context=dispatchers, name='reminder-plan')
+    job_queue.run_daily(dispatch_plans, time=REMIND_TIME, context=dispatchers, name='reminder-dispatch')
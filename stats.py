@@ -0,0 +1,78 @@
+import heapq
+from html import escape
+from collections import Counter
+from datetime import datetime
+from typing import Any, Iterable, Sequence
+
+from pytz import timezone
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from utils.command_util import Command, reply, NEWLINE
+
+# Incremental aggregates kept in bot_data, so queries never scan all remindees.
+# Counters must be updated before the remindees they describe are mutated, since the
+# first access recounts from scratch.
+STATS_KEY = 'stats'
+
+def get_stats(bot_data: dict) -> dict:
+    if not bot_data.get(STATS_KEY):
+        bot_data[STATS_KEY] = recount_stats(bot_data)
+    return bot_data[STATS_KEY]
+
+def recount_stats(bot_data: dict) -> dict:
+    remindees = (bot_data.get('remindees') or {}).values()
+    medication_counts = Counter(medication['name'] for remindee in remindees for medication in remindee['medications'])
+    deliveries = bot_data.get(STATS_KEY, {}).get('deliveries', {'date': None, 'count': 0})
+    return {
+        'users': len(remindees),
+        'medications': sum(medication_counts.values()),
+        'medication_counts': dict(medication_counts),
+        'deliveries': dict(deliveries),
+    }
+
+def count_medications(bot_data: dict, names: Iterable[str], delta: int) -> None:
+    stats = get_stats(bot_data)
+    counts = stats['medication_counts']
+    for name in names:
+        stats['medications'] += delta
+        if (count := counts.get(name, 0) + delta) > 0:
+            counts[name] = count
+        else:
+            counts.pop(name, None)
+
+def count_users(bot_data: dict, delta: int) -> None:
+    get_stats(bot_data)['users'] += delta
+
+def count_delivery(bot_data: dict, count: int=1) -> None:
+    deliveries = get_stats(bot_data)['deliveries']
+    today = datetime.now(timezone('Asia/Tokyo')).date().isoformat()
+    if deliveries['date'] != today:
+        deliveries['date'], deliveries['count'] = today, 0
+    deliveries['count'] += count
+
+def show_stats(update: Update, context: CallbackContext, command: Command, args: Sequence[Any]) -> None:
+    stats = get_stats(context.bot_data)
+    deliveries = stats['deliveries']
+    today = datetime.now(timezone('Asia/Tokyo')).date().isoformat()
+    text = (
+        f'用戶數：{stats["users"]}{NEWLINE}'
+        f'藥物數：{stats["medications"]}（{len(stats["medication_counts"])} 種）{NEWLINE}'
+        f'今日已提醒：{deliveries["count"] if deliveries["date"] == today else 0}'
+    )
+    if args.get('check'):
+        recount = recount_stats(context.bot_data)
+        consistent = all(stats[key] == recount[key] for key in ('users', 'medications', 'medication_counts'))
+        text += f'{NEWLINE}{NEWLINE}一致性檢查：{"通過" if consistent else "不一致，已重新統計"}'
+        if not consistent:
+            context.bot_data[STATS_KEY] = recount
+    reply(update, context, text)
+
+def show_top_medications(update: Update, context: CallbackContext, command: Command, args: Sequence[Any]) -> None:
+    counts = get_stats(context.bot_data)['medication_counts']
+    top = heapq.nlargest(args.get('count', 10), counts.items(), key=lambda item: item[1])
+    if not top:
+        reply(update, context, '沒有任何藥物登記在冊。')
+        return
+    medication_list = '\n'.join(f'{i + 1:>3}  <b>{escape(name)}</b> {count}' for i, (name, count) in enumerate(top))
+    reply(update, context, f'最常見的藥物：{NEWLINE}{NEWLINE}{medication_list}')
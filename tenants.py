@@ -0,0 +1,68 @@
+"""
+Host several bots (tenants) in one process, sharing one connection pool and one job queue
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+from pathlib import Path
+from queue import Queue
+from typing import List, Optional
+
+from telegram import ParseMode
+from telegram.ext import Defaults, Dispatcher, ExtBot, JobQueue, PicklePersistence, Updater
+from telegram.utils.request import Request
+
+BASE_DIR = Path(__file__).parent
+LEGACY_PERSISTENCE_PATH = BASE_DIR / "bot.db"
+WORKERS_PER_TENANT = 4
+
+DEFAULTS = Defaults(
+    parse_mode = ParseMode.HTML,
+    disable_notification=True,
+    disable_web_page_preview=False
+)
+
+def create_request(tenant_count: int) -> Request:
+    """One connection pool shared by all bots, as they all talk to the same API host."""
+    return Request(con_pool_size=(WORKERS_PER_TENANT + 1) * tenant_count + 4)
+
+def persistence_path(token: str, base_dir: Path=BASE_DIR) -> Path:
+    # Keyed by bot id, so reordering tokens never hands one bot another's data
+    return base_dir / f"bot-{token.split(':')[0]}.db"
+
+def migrate_legacy_persistence(tokens: List[str], base_dir: Path=BASE_DIR) -> None:
+    """Adopt the single bot database of older deployments, only when it cannot belong to another bot."""
+    legacy = base_dir / LEGACY_PERSISTENCE_PATH.name
+    if not legacy.exists():
+        return
+    if len(tokens) != 1:
+        logger.warning(f'{legacy} is left alone as several bots are configured, rename it to bot-<BOT ID>.db to adopt it')
+        return
+    if (path := persistence_path(tokens[0], base_dir)).exists():
+        logger.warning(f'{legacy} is left alone as {path} already exists')
+        return
+    logger.info(f'Migrating {legacy} to {path}')
+    legacy.rename(path)
+
+def create_updater(token: str, request: Request, job_queue: JobQueue, path: Path) -> Updater:
+    dispatcher = Dispatcher(
+        ExtBot(token, request=request, defaults=DEFAULTS),
+        Queue(),
+        workers = WORKERS_PER_TENANT,
+        job_queue = job_queue,
+        persistence = PicklePersistence(path),
+        use_context = True,
+    )
+    return Updater(dispatcher=dispatcher, workers=None)
+
+def create_updaters(tokens: List[str], request: Optional[Request]=None, base_dir: Path=BASE_DIR) -> List[Updater]:
+    """Create one updater per token, all sharing ``request`` and a single job queue.
+
+    Jobs get the first bot's dispatcher in their context; jobs of other bots must carry their own.
+    """
+    migrate_legacy_persistence(tokens, base_dir)
+    request = request or create_request(len(tokens))
+    job_queue = JobQueue()
+    updaters = [create_updater(token, request, job_queue, persistence_path(token, base_dir)) for token in tokens]
+    job_queue.set_dispatcher(updaters[0].dispatcher)
+    return updaters
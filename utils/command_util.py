@@ -2,12 +2,14 @@ import json
 import logging
 logger = logging.getLogger()
 
+from utils.deletion_util import get_deletion_scheduler
 from utils.logging_util import bind_logger
+from utils.rate_limit_util import RateLimit, TokenBucketTable
 
 from distutils.util import strtobool
 from telegram import Update, Message
-from telegram.ext import CallbackContext, Dispatcher
-from typing import Any, Callable, Optional, Sequence, Tuple, TypeVar
+from telegram.ext import CallbackContext
+from typing import Any, Callable, Collection, Optional, Sequence, Tuple, TypeVar
 
 class BadUsage(ValueError):
     pass
@@ -32,12 +34,15 @@ class Parameter:
         return f"Parameter({self.name}, {self.type}, {self.desc})"
 
 class Command:
-    def __init__(self, name: str, handler: Callable, description: str, parameters: Sequence[Parameter], last_ignore_space: bool=False) -> None:
+    def __init__(self, name: str, handler: Callable, description: str, parameters: Sequence[Parameter], last_ignore_space: bool=False, rate_limit: Optional[RateLimit]=None, allowed_ids: Optional[Collection[int]]=None) -> None:
         self.name = name
         self.handler = handler
         self.description = description
         self.parameters = parameters
         self.last_ignore_space = last_ignore_space
+        self.rate_limit = rate_limit
+        self.buckets = TokenBucketTable(rate_limit) if rate_limit else None
+        self.allowed_ids = allowed_ids
         
     def __str__(self) -> str:
         return f"Command({self.name}, {self.description})"
@@ -45,12 +50,28 @@ class Command:
     def print_usage(self, update: Update, delete_after_secs: int=0) -> None:
         do_command_usage = lambda: command_usage(self.name, self.parameters, self.description, update.effective_message)
         if delete_after_secs:
-            delete_after(delete_after_secs)(do_command_usage())
+            delete_after(delete_after_secs)(do_command_usage)()
         else:
             do_command_usage()
     
+    def is_allowed(self, update: Update) -> bool:
+        """Commands with ``allowed_ids`` only answer those users or chats."""
+        if self.allowed_ids is None:
+            return True
+        user_id = update.effective_user.id if update.effective_user else None
+        return user_id in self.allowed_ids or update.effective_chat.id in self.allowed_ids
+
+    def render_usage(self) -> str:
+        return render_usage(self.name, self.parameters, self.description)
+
     def get_handler(self) -> Callable:
         def handler(update: Update, context: CallbackContext):
+            if not self.is_allowed(update):
+                bind_logger(update, __name__).debug(f'/{self.name} is restricted, ignoring')
+                return
+            if self.buckets and not self.buckets.consume(update.effective_user.id if update.effective_user else update.effective_chat.id):
+                bind_logger(update, __name__).debug(f'Rate limit of /{self.name} exceeded, ignoring')
+                return
             try:
                 args = parse_command(self.parameters, self.description, update, self.last_ignore_space)
             except BadUsage as e:
@@ -107,20 +128,6 @@ def parse_command(parameters: Sequence[Parameter], description: str, update: Upd
 
     return result
 
-import time
-
-def _delete_after(delay: int, message: Message):
-    """Delete message after specified seconds.
-
-    Args:
-        delay (int): Delay in secs
-        message (Message): Message to delete
-    """
-    time.sleep(delay)
-    message.delete()
-    logger.debug(f'Message {message.message_id} in {message.chat.type} chat {message.chat.id} deleted:\n{message.text}')
-    return
-
 RT = TypeVar('RT')
 def delete_after(delay: int) -> Callable[[Callable[..., Message]], Callable[..., None]]:
     def decorator(func: Callable[..., Message]) -> Callable[..., None]:
@@ -128,8 +135,7 @@ def delete_after(delay: int) -> Callable[[Callable[..., Message]], Callable[...,
             sent_message = func(*args, **kwargs)
             if not isinstance(sent_message, Message):
                 raise TypeError('Message sender is not returning sent message')
-            dispatcher = Dispatcher.get_instance()
-            dispatcher.run_async(_delete_after, delay, sent_message)
+            get_deletion_scheduler(sent_message.bot).schedule(delay, sent_message)
         return wrapper
     return decorator
 
@@ -143,16 +149,26 @@ def command_usage(command: str, parameters: list[Parameter], description: str, r
         description (str): Description of Command
         reply_to (Message): User Message of Bad Usage
     """
+    sent_message = reply_to.reply_text(
+        f"<b>コマンドヘルプ</b>\n{ render_usage(command, parameters, description) }")
+    
+    return sent_message
+
+def render_usage(command: str, parameters: list[Parameter], description: str) -> str:
+    """Render the usage help of a command.
+
+    Args:
+        command (str): Command Name
+        parameters (Sequence[Parameter]): Parameters of Command
+        description (str): Description of Command
+    """
     command_repr = f"/{command} {' '.join(f'⟨{param.name}⟩' for param in parameters)}"
     if parameters:
         max_length = max(len(param.name) for param in parameters)
         paramtr_desc = "\n".join(f"    <code>{param.name.rjust(max_length)}</code> - {param.desc} " for param in parameters)
     else:
         paramtr_desc = "〈引数なし〉"
-    sent_message = reply_to.reply_text(
-        f"<b>コマンドヘルプ</b>\n<code>{ command_repr }</code>\n\n{ description }\n{ paramtr_desc }")
-    
-    return sent_message
+    return f"<code>{ command_repr }</code>\n\n{ description }\n{ paramtr_desc }"
 
 MAX_MESSAGE_TXT_LENGTH = 4096
 RESERVE_SPACE = 10
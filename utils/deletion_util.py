@@ -0,0 +1,110 @@
+"""
+Persistent scheduler for auto-deleting messages
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import heapq
+import time
+from threading import Lock
+from typing import Dict, Optional
+
+from telegram import Bot, Message
+from telegram.error import TelegramError
+from telegram.ext import CallbackContext, Dispatcher, Job, JobQueue
+
+class DeletionScheduler:
+    """Delete messages after a deadline without occupying a worker thread.
+
+    Pending deletions are kept in a min-heap of ``(deadline, chat_id, message_id)`` stored in
+    ``bot_data`` so they survive restarts. A single one-shot job is armed for the earliest deadline
+    and re-armed after each batch, so nothing runs while nothing is due and batches never overlap.
+    When the heap is full, its earliest entries are moved to an overdue list swept first; beyond
+    that too, deletions are dropped. Scheduling never calls the API.
+    """
+    BOT_DATA_KEY = 'pending_deletions'
+    OVERDUE_BOT_DATA_KEY = 'overdue_deletions'
+
+    def __init__(self, max_pending: int=1000, batch_size: int=30, interval: float=1) -> None:
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.interval = interval
+        self.heap: list = []
+        self.overdue: list = []
+        self._dispatcher: Optional[Dispatcher] = None
+        self._job_queue: Optional[JobQueue] = None
+        self._job: Optional[Job] = None
+        self._armed_at: Optional[float] = None
+        self._lock = Lock()
+
+    def attach(self, dispatcher: Dispatcher, job_queue: Optional[JobQueue]=None) -> None:
+        """Load persisted deletions from ``bot_data`` and sweep them on ``job_queue``, which may be shared between bots."""
+        with self._lock:
+            heap = dispatcher.bot_data.setdefault(self.BOT_DATA_KEY, [])
+            heap.extend(self.heap)
+            heapq.heapify(heap)
+            self.heap = heap
+            overdue = dispatcher.bot_data.setdefault(self.OVERDUE_BOT_DATA_KEY, [])
+            overdue.extend(self.overdue)
+            self.overdue = overdue
+            self._dispatcher = dispatcher
+            self._job_queue = job_queue or dispatcher.job_queue
+            self._arm()
+        logger.debug(f'{len(self.heap) + len(self.overdue)} pending deletions loaded')
+
+    def _arm(self, not_before: float=0) -> None:
+        """Make sure a sweep runs at the earliest deadline, must be called with the lock held."""
+        if not self._job_queue or not (self.heap or self.overdue):
+            return
+        due = max(time.time() if self.overdue else self.heap[0][0], not_before)
+        if self._armed_at is not None and self._armed_at <= due:
+            return
+        if self._job:
+            self._job.schedule_removal()
+        self._armed_at = due
+        self._job = self._job_queue.run_once(self.sweep, max(due - time.time(), 0), name=f"deletion-sweep-{self._dispatcher.bot.token.split(':')[0]}")
+
+    def schedule(self, delay: float, message: Message) -> None:
+        with self._lock:
+            heapq.heappush(self.heap, (time.time() + delay, message.chat_id, message.message_id))
+            if len(self.heap) > self.max_pending:
+                # The earliest deadline is closest to due anyway, let the next sweep delete it early
+                overflow = heapq.heappop(self.heap)
+                if len(self.overdue) < self.max_pending:
+                    self.overdue.append(overflow)
+                else:
+                    logger.warning(f'Too many pending deletions, message {overflow[2]} in chat {overflow[1]} will not be deleted')
+            self._arm()
+
+    def sweep(self, context: CallbackContext) -> None:
+        now = time.time()
+        with self._lock:
+            self._job = self._armed_at = None
+            expired = self.overdue[:self.batch_size]
+            del self.overdue[:self.batch_size]
+            while self.heap and self.heap[0][0] <= now and len(expired) < self.batch_size:
+                expired.append(heapq.heappop(self.heap))
+        for _, chat_id, message_id in expired:
+            self._delete(self._dispatcher.bot, chat_id, message_id)
+        with self._lock:
+            # Leave a gap after each batch, so the API is not hammered by back to back sweeps
+            self._arm(not_before=time.time() + self.interval)
+        # The job queue may be shared and bound to another bot's dispatcher, which it persists instead
+        self._dispatcher.update_persistence()
+
+    @staticmethod
+    def _delete(bot: Bot, chat_id: int, message_id: int) -> None:
+        try:
+            bot.delete_message(chat_id=chat_id, message_id=message_id)
+            logger.debug(f'Message {message_id} in chat {chat_id} deleted')
+        except TelegramError as e:
+            logger.debug(f'Failed to delete message {message_id} in chat {chat_id}: {e}')
+
+    def __len__(self) -> int:
+        return len(self.heap) + len(self.overdue)
+
+DELETION_SCHEDULERS: Dict[str, DeletionScheduler] = {}
+
+def get_deletion_scheduler(bot: Bot) -> DeletionScheduler:
+    """Deletion scheduler of a bot, as message ids are only meaningful to the bot that sent them."""
+    return DELETION_SCHEDULERS.setdefault(bot.token, DeletionScheduler())
@@ -0,0 +1,109 @@
+"""
+Token bucket based rate limiting and flood protection
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Hashable, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext, DispatcherHandlerStop, Filters, MessageHandler
+
+from utils.logging_util import bind_logger
+
+@dataclass(frozen=True)
+class RateLimit:
+    rate: float      # tokens refilled per second
+    capacity: float  # burst size
+
+    @classmethod
+    def per_minute(cls, count: float, burst: Optional[float]=None) -> 'RateLimit':
+        return cls(count / 60, burst if burst is not None else count)
+
+class TokenBucketTable:
+    """A table of token buckets keyed by arbitrary hashable keys.
+
+    Each bucket is stored as ``[tokens, last_refill]`` and refilled lazily on access,
+    so a check is O(1). Least recently used buckets are evicted beyond ``max_keys``.
+    """
+    def __init__(self, limit: RateLimit, max_keys: int=10000) -> None:
+        self.limit = limit
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[Hashable, list]' = OrderedDict()
+        self._lock = Lock()
+
+    def consume(self, key: Hashable, cost: float=1, now: Optional[float]=None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if (bucket := self._buckets.get(key)) is None:
+                bucket = self._buckets[key] = [self.limit.capacity, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.limit.capacity, bucket[0] + (now - bucket[1]) * self.limit.rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+    def refund(self, key: Hashable, cost: float=1) -> None:
+        """Give back tokens consumed for something that did not happen after all."""
+        with self._lock:
+            if (bucket := self._buckets.get(key)) is not None:
+                bucket[0] = min(self.limit.capacity, bucket[0] + cost)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+# Bursty on purpose: a registration sends several /add in a row
+DEFAULT_USER_LIMIT = RateLimit.per_minute(30, burst=15)
+DEFAULT_CHAT_LIMIT = RateLimit.per_minute(60, burst=20)
+
+class FloodGuard:
+    """Dispatcher level middleware dropping commands from flooding users and chats.
+
+    Only new command messages are charged, so ordinary chatter and conversation replies never trip it.
+    The first dropped command of a flood is answered with a notice, so legitimate users know to slow down.
+    Register with ``dispatcher.add_handler(guard.get_handler(), group=-1)`` so it runs before any other handler.
+    """
+    NOTICE = '您發送得太快了，請稍後再試。'
+
+    def __init__(self, user_limit: RateLimit=DEFAULT_USER_LIMIT, chat_limit: RateLimit=DEFAULT_CHAT_LIMIT) -> None:
+        self.users = TokenBucketTable(user_limit)
+        self.chats = TokenBucketTable(chat_limit)
+        # Noticed (user_id, chat_id) pairs, least recently used evicted like the buckets
+        self._noticed: 'OrderedDict[tuple, None]' = OrderedDict()
+        self._lock = Lock()
+
+    def check(self, user_id: Optional[int], chat_id: Optional[int], now: Optional[float]=None) -> bool:
+        if user_id is not None and not self.users.consume(user_id, now=now):
+            return False
+        if chat_id is not None and not self.chats.consume(chat_id, now=now):
+            return False
+        return True
+
+    def get_handler(self) -> MessageHandler:
+        def handler(update: Update, context: CallbackContext):
+            user_id = update.effective_user.id if update.effective_user else None
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            if self.check(user_id, chat_id):
+                with self._lock:
+                    self._noticed.pop((user_id, chat_id), None)
+                return
+            bind_logger(update, __name__).debug(f'Flood detected from user {user_id} in chat {chat_id}, dropping update')
+            with self._lock:
+                notice = (user_id, chat_id) not in self._noticed
+                self._noticed[(user_id, chat_id)] = None
+                self._noticed.move_to_end((user_id, chat_id))
+                if len(self._noticed) > self.users.max_keys:
+                    self._noticed.popitem(last=False)
+            if notice:
+                update.effective_message.reply_text(self.NOTICE)
+            raise DispatcherHandlerStop()
+        return MessageHandler(Filters.update.message & Filters.command, handler)